@@ -14,6 +14,7 @@ width = 16
 height = int(detection_length / cell_length)
 car_occupancy = 1
 bus_occupancy = 1
+speed_limit = 20.12  # The highest lane speed in the network (m/s)
 # min_left_green_time = 5
 # min_through_green_time = 12
 min_green_time = 5
@@ -35,6 +36,7 @@ phase_state_map = {
     6: 'gGGrgrrrrgGGrgrrrr',  # ST NT
     7: 'gGGGgrrrrgrrrgrrrr'  # NL NT
 }
+state_phase_map = {v: k for k, v in phase_state_map.items()}
 
 
 class SumoEnv(gym.Env):
@@ -103,11 +105,7 @@ class SumoEnv(gym.Env):
             if self.sim_step == 600:
                 self.last_state, self.last_tot_person_delay = self.get_state()
                 last_p = traci.trafficlight.getRedYellowGreenState('J1')
-                for k, v in phase_state_map.items():
-                    if v == last_p:
-                        self.last_phase = k
-                    else:
-                        self.last_phase = 0
+                self.last_phase = state_phase_map.get(last_p, 0)
                 return self.last_state, {}
             traci.simulationStep()
             self.sim_step += 1
@@ -279,27 +277,17 @@ class SumoEnv(gym.Env):
 
     # Activate the corresponding yellow and red phase
     def set_yellow_red(self, phase, last_phase):
-        phase_state = phase_state_map[phase]
-        old_phase_state = phase_state_map[last_phase]
-        yellow_state = []
-        red_state = []
-        for i in range(18):
-            # print(action_state[i], old_action_state[i])
-            if old_phase_state[i] == 'G' and old_phase_state[i] != phase_state[i]:
-                yellow_state.append('Y')
-            else:
-                yellow_state.append(old_phase_state[i])
-        yellow_state = ''.join(yellow_state)
-        traci.trafficlight.setRedYellowGreenState('J1', yellow_state)
+        phase_state = np.frombuffer(phase_state_map[phase].encode(), dtype=np.uint8)
+        old_phase_state = np.frombuffer(phase_state_map[last_phase].encode(), dtype=np.uint8)
+        # The green movements that end turn yellow and then red
+        ending = (old_phase_state == ord('G')) & (old_phase_state != phase_state)
+        transition_state = old_phase_state.copy()
+        transition_state[ending] = ord('Y')
+        traci.trafficlight.setRedYellowGreenState('J1', transition_state.tobytes().decode())
         self.simulate(self.yellow_time)
 
-        for i in range(18):
-            if yellow_state[i] == 'Y':
-                red_state.append('r')
-            else:
-                red_state.append(yellow_state[i])
-        red_state = ''.join(red_state)
-        traci.trafficlight.setRedYellowGreenState('J1', red_state)
+        transition_state[ending] = ord('r')
+        traci.trafficlight.setRedYellowGreenState('J1', transition_state.tobytes().decode())
         self.simulate(self.red_time)
 
     def save_episode_stats(self):
@@ -4,7 +4,17 @@ from gymnasium import spaces
 import timeit
 
 import numpy as np
-import traci
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+# libsumo runs SUMO inside the worker process instead of talking to it over a TraCI socket. Each SubprocVecEnv
+# worker gets its own instance, which is the supported setup. It does not work with sumo-gui, and '--remote-port'
+# must not be part of sumo_cmd when it is used.
+try:
+    import libsumo as traci
+except ImportError:
+    import traci
 import traci.constants as tc
 
 cell_length = 7
@@ -12,6 +22,7 @@ detection_length = 350
 n_channels = 2
 width = 16
 height = int(detection_length / cell_length)
+context_range = detection_length + 50  # Radius around J1 to cover the detection area plus the junction itself
 car_occupancy = 1
 bus_occupancy = 1
 min_left_green_time = 5
@@ -24,6 +35,8 @@ edges = {
     'north_edge': (12, 'E1')
 }
 incoming_edges = ['-E2', '-E3', 'E0', 'E1']
+vehicle_type_map = {'car': 0, 'cv': 1, 'bus': 2}  # Other types (e.g. 'av') are coded as -1
+lane_index_map = {f'{edge[1]}_{i}': edge[0] + i for edge in edges.values() for i in range(4)}  # lane id: width index
 action_state_map = {
     0: 'grrrgrrGGgrrrgrrGG',  # WL EL
     1: 'grrrgrrrrgrrrgGGGG',  # WL WT
@@ -34,6 +47,34 @@ action_state_map = {
     6: 'gGGrgrrrrgGGrgrrrr',  # ST NT
     7: 'gGGGgrrrrgrrrgrrrr'  # NL NT
 }
+state_action_map = {v: k for k, v in action_state_map.items()}
+# Yellow and red transition states for every (last action, action) pair, the green movements that end turn yellow
+yellow_state_map = {
+    (last_action, action): ''.join('Y' if old_s == 'G' and old_s != new_s else old_s
+                                   for old_s, new_s in zip(old_action_state, action_state))
+    for last_action, old_action_state in action_state_map.items()
+    for action, action_state in action_state_map.items()
+}
+red_state_map = {k: v.replace('Y', 'r') for k, v in yellow_state_map.items()}
+
+
+# Place the detected vehicles in the image state
+if njit is not None:
+    # Compiled loop without the boolean-mask copies, cell_length and detection_length are compiled in as constants
+    @njit(cache=True)
+    def fill_img_state(img_state, detected, ps_tls, width_index, v_occupancy, spd):
+        for k in range(ps_tls.shape[0]):
+            if detected[k] and 0 < ps_tls[k] < detection_length:
+                height_index = int(ps_tls[k] / cell_length)
+                img_state[0, height_index, width_index[k]] = v_occupancy[k]
+                img_state[1, height_index, width_index[k]] = min(spd[k], 255)  # speed in m/s fits in uint8
+else:
+    def fill_img_state(img_state, detected, ps_tls, width_index, v_occupancy, spd):
+        in_range = detected & (ps_tls > 0) & (ps_tls < detection_length)
+        height_index = (ps_tls[in_range] / cell_length).astype(int)
+        width_index = width_index[in_range]
+        img_state[0, height_index, width_index] = v_occupancy[in_range]
+        img_state[1, height_index, width_index] = np.minimum(spd[in_range], 255)  # speed in m/s fits in uint8
 
 
 class SumoEnv(gym.Env):
@@ -79,6 +120,13 @@ class SumoEnv(gym.Env):
         self.red_time = 2
         self.min_left_green_time = min_left_green_time
         self.min_through_green_time = min_through_green_time
+        # Detector lanes and their width index in the state array
+        self.lane_ids = list(lane_index_map)
+        self.lane_width_index = np.array(list(lane_index_map.values()), dtype=np.intp)
+        # Observation buffer reused by every get_state call, the comb mode adds the queue plane after the image
+        n_planes = n_channels + 1 if self.obs_type == 'comb' else n_channels
+        self.obs_state = np.zeros((n_planes, height, width), dtype=np.uint8)
+        self.img_state = self.obs_state[:n_channels]
 
     def reset(self, seed=None, options=None):
         self.episode += 1
@@ -95,21 +143,22 @@ class SumoEnv(gym.Env):
 
         # print(f'---Episode: {self.episode}--- Simulating...')
         traci.start(self.sumo_cmd)
+        # Subscribe once per episode, the results are then refreshed by every simulation step
+        traci.junction.subscribeContext('J1', tc.CMD_GET_VEHICLE_VARIABLE, context_range,
+                                        (tc.VAR_LANE_ID, tc.VAR_LANEPOSITION, tc.VAR_SPEED, tc.VAR_TYPE,
+                                         tc.VAR_TIMELOSS))
+        for ln_id in self.lane_ids:
+            traci.lane.subscribe(ln_id, (tc.LAST_STEP_VEHICLE_HALTING_NUMBER,))
+        self.lane_length = {ln_id: traci.lane.getLength(ln_id) for ln_id in self.lane_ids}
+        self.veh_type_cache = {}  # vehicle id: type code, filled when a vehicle is first seen
 
         # Warm up 10 minutes
-        while self.sim_step <= 600:
-            if self.sim_step == 600:
-                self.last_state, self.last_tot_person_delay = self.get_state()
-                last_phase = traci.trafficlight.getRedYellowGreenState('J1')
-                for k, v in action_state_map.items():
-                    if v == last_phase:
-                        self.last_action = k
-                    else:
-                        self.last_action = 0
-                return self.last_state, {}
-            traci.simulationStep()
-            self.sim_step += 1
+        self.simulate(600)
+        self.last_state, self.last_tot_person_delay = self.get_state()
+        last_phase = traci.trafficlight.getRedYellowGreenState('J1')
+        self.last_action = state_action_map.get(last_phase, 0)
         # print(self.last_state)
+        return self.last_state, {}
 
     def step(self, action):
         # Take the action: Signal control
@@ -155,105 +204,64 @@ class SumoEnv(gym.Env):
 
     # Get the state
     def get_state(self):
-        img_state = np.zeros((n_channels, height, width))
+        img_state = self.img_state
+        img_state.fill(0)
         queue_state = np.zeros(width)
         tot_person_delay = 0
-        tot_queue_veh = 0
-
-        for veh_id in traci.vehicle.getIDList():
-            traci.vehicle.subscribe(veh_id, (tc.VAR_NEXT_TLS, tc.VAR_LANE_ID, tc.VAR_SPEED, tc.VAR_TYPE,
-                                             tc.VAR_TIMELOSS))
-        p = traci.vehicle.getAllSubscriptionResults()
-        for x in p:
-            v_type = p[x][tc.VAR_TYPE]
-            # Not the only cv detection mode
-            if not self.cv_det:
-                if p[x][tc.VAR_NEXT_TLS]:
-                    ps_tls = p[x][tc.VAR_NEXT_TLS][0][2]  # get the distance to the traffic light
-                else:
-                    ps_tls = -1  # vehicle crossing the stop line is set to a negative value
-
-                if p[x][tc.VAR_LANE_ID]:
-                    ln_id, ln_idx = p[x][tc.VAR_LANE_ID].split('_')  # get the lane id and index
-
-                spd = p[x][tc.VAR_SPEED]  # get the speed
-
-                if ps_tls > 0:  # vehicle not crossing the stop line
-                    delay = p[x][tc.VAR_TIMELOSS]
-                else:  # vehicle already crossing the stop line
-                    delay = 0
-
-                # get the vehicle type and assign the occupancy
-                if v_type == 'car':
-                    v_occupancy = car_occupancy
-                    person_delay = delay * car_occupancy
-                else:
-                    v_occupancy = bus_occupancy
-                    person_delay = delay * bus_occupancy
-                tot_person_delay += person_delay
-
-                # get the position in state array
-                if 0 < ps_tls < detection_length:
-                    height_index = int(ps_tls / cell_length)
-                    for edge in edges.values():
-                        if edge[1] in ln_id:
-                            width_index = int(ln_idx) + edge[0]
-                            img_state[:, height_index, width_index] = (v_occupancy, spd)
+
+        p = traci.junction.getContextSubscriptionResults('J1') or {}  # None when there is no vehicle data
+        # Only the vehicles on the detector lanes are still approaching the traffic light, the others are skipped
+        veh_ids = [veh_id for veh_id, v in p.items() if v[tc.VAR_LANE_ID] in lane_index_map]
+        if veh_ids:
+            # Gather the subscription results into arrays once, the state is filled without a per-vehicle loop
+            veh_vars = [p[veh_id] for veh_id in veh_ids]
+            # The type of a vehicle never changes, so it is only mapped to a code when the vehicle is first seen
+            for veh_id in set(veh_ids) - self.veh_type_cache.keys():
+                self.veh_type_cache[veh_id] = vehicle_type_map.get(p[veh_id][tc.VAR_TYPE], -1)
+            v_type = np.fromiter((self.veh_type_cache[veh_id] for veh_id in veh_ids), dtype=np.int8,
+                                 count=len(veh_ids))
+            # get the distance to the traffic light, which ends every detector lane (libsumo cannot return
+            # VAR_NEXT_TLS in subscriptions)
+            ps_tls = np.array([self.lane_length[v[tc.VAR_LANE_ID]] - v[tc.VAR_LANEPOSITION] for v in veh_vars])
+            # get the width index from the lane id
+            width_index = np.array([lane_index_map[v[tc.VAR_LANE_ID]] for v in veh_vars])
+            spd = np.array([v[tc.VAR_SPEED] for v in veh_vars])  # get the speed
+            delay = np.array([v[tc.VAR_TIMELOSS] for v in veh_vars])
+
             # The only cv detection mode on
+            if self.cv_det:
+                detected = (v_type == vehicle_type_map['cv']) | (v_type == vehicle_type_map['bus'])
+                car_type = vehicle_type_map['cv']
+            # Not the only cv detection mode
             else:
-                if v_type == 'cv' or v_type == 'bus':
-                    if p[x][tc.VAR_NEXT_TLS]:
-                        ps_tls = p[x][tc.VAR_NEXT_TLS][0][2]  # get the distance to the traffic light
-                    else:
-                        ps_tls = -1  # vehicle crossing the stop line is set to a negative value
-
-                    if p[x][tc.VAR_LANE_ID]:
-                        ln_id, ln_idx = p[x][tc.VAR_LANE_ID].split('_')  # get the lane id and index
-
-                    spd = p[x][tc.VAR_SPEED]  # get the speed
-
-                    if ps_tls > 0:  # vehicle not crossing the stop line
-                        delay = p[x][tc.VAR_TIMELOSS]
-                    else:  # vehicle already crossing the stop line
-                        delay = 0
-
-                    # get the vehicle type and assign the occupancy
-                    if v_type == 'cv':
-                        v_occupancy = car_occupancy
-                        person_delay = delay * car_occupancy
-                    else:
-                        v_occupancy = bus_occupancy
-                        person_delay = delay * bus_occupancy
-                    tot_person_delay += person_delay
-
-                    # get the position in state array
-                    if 0 < ps_tls < detection_length:
-                        height_index = int(ps_tls / cell_length)
-                        for edge in edges.values():
-                            if edge[1] in ln_id:
-                                width_index = int(ln_idx) + edge[0]
-                                img_state[:, height_index, width_index] = (v_occupancy, spd)
-
-        for edge in edges.values():
-            for i in range(4):
-                width_index = i + edge[0]
-                ln_id = f'{edge[1]}_{i}'
-                queue_veh_lane = traci.lane.getLastStepHaltingNumber(ln_id)
-                queue_state[width_index] = traci.lane.getLastStepHaltingNumber(ln_id)
-                tot_queue_veh += queue_veh_lane
+                detected = np.ones(len(veh_vars), dtype=bool)
+                car_type = vehicle_type_map['car']
+
+            # get the vehicle type and assign the occupancy
+            v_occupancy = np.where(v_type == car_type, car_occupancy, bus_occupancy)
+            # vehicle already crossing the stop line has no delay
+            person_delay = np.where(ps_tls > 0, delay, 0) * v_occupancy
+            tot_person_delay = person_delay[detected].sum()
+
+            # get the position in state array
+            fill_img_state(img_state, detected, ps_tls, width_index, v_occupancy, spd)
+
+        lane_results = traci.lane.getAllSubscriptionResults()
+        queue_veh = np.fromiter((lane_results[ln_id][tc.LAST_STEP_VEHICLE_HALTING_NUMBER] for ln_id in self.lane_ids),
+                                dtype=np.int32, count=len(self.lane_ids))
+        queue_state[self.lane_width_index] = queue_veh
+        tot_queue_veh = int(queue_veh.sum())
 
         if self.obs_type == 'img':
-            state = img_state
-            state = state.astype(np.uint8)
+            state = self.obs_state.copy()  # the returned state is kept as last_state and terminal_observation
             # return state, tot_person_delay
 
         # Count the stopped vehicles on each lane, speed <= 0.1
         elif self.obs_type == 'comb':
-            # Concatenate the queue array with the image state, after this, the dimension is (3, 50, 16)
-            queue_array = np.zeros((1, height, width))
-            queue_array[:, 0, :] += queue_state
-            state = np.concatenate((img_state, queue_array), axis=0)
-            state = state.astype(np.uint8)
+            # Write the queue into the first row of the plane after the image, after this, the dimension is (3, 50, 16)
+            # The other rows of the queue plane are never written and stay zero
+            self.obs_state[n_channels, 0, self.lane_width_index] = np.minimum(queue_veh, 255)
+            state = self.obs_state.copy()
 
             # state = {
             #     'img': img_state,
@@ -267,10 +275,10 @@ class SumoEnv(gym.Env):
 
     # Execute the designated simulation step
     def simulate(self, steps_todo):
-        while steps_todo > 0:
-            traci.simulationStep()
-            self.sim_step += 1
-            steps_todo -= 1
+        if steps_todo > 0:
+            # SUMO runs up to the target time (1 s steps) within a single call
+            self.sim_step += steps_todo
+            traci.simulationStep(self.sim_step)
 
     def set_green(self, action, min_green_time):
         """
@@ -284,27 +292,10 @@ class SumoEnv(gym.Env):
 
     # Activate the corresponding yellow and red phase
     def set_yellow_red(self, action, last_action):
-        action_state = action_state_map[action]
-        old_action_state = action_state_map[last_action]
-        yellow_state = []
-        red_state = []
-        for i in range(18):
-            # print(action_state[i], old_action_state[i])
-            if old_action_state[i] == 'G' and old_action_state[i] != action_state[i]:
-                yellow_state.append('Y')
-            else:
-                yellow_state.append(old_action_state[i])
-        yellow_state = ''.join(yellow_state)
-        traci.trafficlight.setRedYellowGreenState('J1', yellow_state)
+        traci.trafficlight.setRedYellowGreenState('J1', yellow_state_map[(last_action, action)])
         self.simulate(self.yellow_time)
 
-        for i in range(18):
-            if yellow_state[i] == 'Y':
-                red_state.append('r')
-            else:
-                red_state.append(yellow_state[i])
-        red_state = ''.join(red_state)
-        traci.trafficlight.setRedYellowGreenState('J1', red_state)
+        traci.trafficlight.setRedYellowGreenState('J1', red_state_map[(last_action, action)])
         self.simulate(self.red_time)
 
     def save_episode_stats(self):
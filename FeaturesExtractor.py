@@ -13,15 +13,37 @@ from stable_baselines3.common.vec_env.base_vec_env import VecEnvStepReturn
 from copy import deepcopy
 
 
+def bf16_supported() -> bool:
+    """
+    Whether bfloat16 runs natively on the training device (an Ampere or newer GPU, or a CPU with AVX512-BF16/AMX).
+    Elsewhere bfloat16 is emulated and slower than float32. On CUDA this initializes the context, so it must not be
+    called before forking subprocesses.
+    """
+    if th.cuda.is_available():
+        # th.cuda.is_bf16_supported() also reports emulated support on older GPUs
+        return th.cuda.get_device_capability()[0] >= 8
+    # The CPU feature checks are private helpers of torch >= 2.1
+    cpu_checks = ('_is_avx512_bf16_supported', '_is_amx_tile_supported')
+    return any(getattr(th.cpu, check, lambda: False)() for check in cpu_checks)
+
+
 class CustomCNN(BaseFeaturesExtractor):
     """
     :param observation_space: (gym.Space)
     :param features_dim: (int) Number of features extracted.
         This corresponds to the number of unit for the last layer.
+    :param mixed_precision: (bool) Run the forward pass in bfloat16 autocast on channels-last inputs.
+    :param channel_scale: (Sequence[float]) Divisor for each input channel (e.g. occupancy, speed limit),
+        for use without observation normalization. None leaves the inputs unchanged.
     """
 
-    def __init__(self, observation_space: gym.Space, features_dim: int = 256):
+    def __init__(self, observation_space: gym.Space, features_dim: int = 256, mixed_precision: bool = False,
+                 channel_scale=None):
         super().__init__(observation_space, features_dim)
+        self.mixed_precision = mixed_precision
+        if channel_scale is not None:
+            channel_scale = th.as_tensor(channel_scale, dtype=th.float32).view(-1, 1, 1)
+        self.register_buffer('channel_scale', channel_scale)
         # We assume CxHxW images (channels first)
         # Re-ordering will be done by pre-preprocessing or wrapper
         n_input_channels = observation_space.shape[0]
@@ -42,11 +64,22 @@ class CustomCNN(BaseFeaturesExtractor):
         self.linear = nn.Sequential(nn.Linear(n_flatten, features_dim), nn.ReLU())
 
     def forward(self, observations: th.Tensor) -> th.Tensor:
-        return self.linear(self.cnn(observations))
+        if self.channel_scale is not None:
+            observations = observations / self.channel_scale
+
+        if not self.mixed_precision:
+            return self.linear(self.cnn(observations))
+
+        # bfloat16 keeps the float32 range, so no gradient scaling is needed on either CPU or CUDA
+        with th.autocast(observations.device.type, dtype=th.bfloat16):
+            features = self.linear(self.cnn(observations.contiguous(memory_format=th.channels_last)))
+        # The policy and value heads after the extractor stay in float32
+        return features.float()
 
 
 class CustomCombinedExtractor(BaseFeaturesExtractor):
-    def __init__(self, observation_space: spaces.Dict, features_dim: int = 256):
+    def __init__(self, observation_space: spaces.Dict, features_dim: int = 256, mixed_precision: bool = False,
+                 channel_scale=None):
         # We do not know features-dim here before going over all the items,
         # so put something dummy for now. PyTorch requires calling
         # nn.Module.__init__ before adding modules
@@ -59,7 +92,8 @@ class CustomCombinedExtractor(BaseFeaturesExtractor):
         # so go over all the spaces and compute output feature sizes
         for key, subspace in observation_space.spaces.items():
             if key == "img":
-                extractors[key] = CustomCNN(subspace, features_dim=features_dim)
+                extractors[key] = CustomCNN(subspace, features_dim=features_dim, mixed_precision=mixed_precision,
+                                            channel_scale=channel_scale)
                 total_concat_size += features_dim
 
             elif key == "vec":
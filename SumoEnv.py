@@ -34,6 +34,7 @@ action_state_map = {
     6: 'gGGrgrrrrgGGrgrrrr',  # ST NT
     7: 'gGGGgrrrrgrrrgrrrr'  # NL NT
 }
+state_action_map = {v: k for k, v in action_state_map.items()}
 
 
 class SumoEnv(gym.Env):
@@ -100,11 +101,7 @@ class SumoEnv(gym.Env):
             if self.sim_step == 600:
                 self.last_state, self.last_tot_person_delay = self.get_state()
                 last_phase = traci.trafficlight.getRedYellowGreenState('J1')
-                for k, v in action_state_map.items():
-                    if v == last_phase:
-                        self.last_action = k
-                    else:
-                        self.last_action = 0
+                self.last_action = state_action_map.get(last_phase, 0)
                 return self.last_state, {}
             traci.simulationStep()
             self.sim_step += 1
@@ -280,27 +277,17 @@ class SumoEnv(gym.Env):
 
     # Activate the corresponding yellow and red phase
     def set_yellow_red(self, action, last_action):
-        action_state = action_state_map[action]
-        old_action_state = action_state_map[last_action]
-        yellow_state = []
-        red_state = []
-        for i in range(18):
-            # print(action_state[i], old_action_state[i])
-            if old_action_state[i] == 'G' and old_action_state[i] != action_state[i]:
-                yellow_state.append('Y')
-            else:
-                yellow_state.append(old_action_state[i])
-        yellow_state = ''.join(yellow_state)
-        traci.trafficlight.setRedYellowGreenState('J1', yellow_state)
+        action_state = np.frombuffer(action_state_map[action].encode(), dtype=np.uint8)
+        old_action_state = np.frombuffer(action_state_map[last_action].encode(), dtype=np.uint8)
+        # The green movements that end turn yellow and then red
+        ending = (old_action_state == ord('G')) & (old_action_state != action_state)
+        transition_state = old_action_state.copy()
+        transition_state[ending] = ord('Y')
+        traci.trafficlight.setRedYellowGreenState('J1', transition_state.tobytes().decode())
         self.simulate(self.yellow_time)
 
-        for i in range(18):
-            if yellow_state[i] == 'Y':
-                red_state.append('r')
-            else:
-                red_state.append(yellow_state[i])
-        red_state = ''.join(red_state)
-        traci.trafficlight.setRedYellowGreenState('J1', red_state)
+        transition_state[ending] = ord('r')
+        traci.trafficlight.setRedYellowGreenState('J1', transition_state.tobytes().decode())
         self.simulate(self.red_time)
 
     def save_episode_stats(self):
@@ -1,18 +1,20 @@
 import time
 import datetime
+import sys
+import torch as th
 
 from utils import *
-from EnvMultiDiscrete import SumoEnv
+from EnvMultiDiscrete import SumoEnv, car_occupancy, bus_occupancy, speed_limit
 
 from DoubleDQN import DoubleDQN
 from stable_baselines3 import DQN, PPO
 from stable_baselines3.common.env_util import make_vec_env
 from stable_baselines3.common.vec_env import VecNormalize, SubprocVecEnv, DummyVecEnv, VecMonitor
 from stable_baselines3.common.utils import get_linear_fn
-from FeaturesExtractor import CustomCNN, CustomCombinedExtractor, SaveOnBestTrainingRewardCallback
+from FeaturesExtractor import CustomCNN, CustomCombinedExtractor, SaveOnBestTrainingRewardCallback, bf16_supported
 
 
-def learn(obs_type, cv=False):
+def learn(obs_type, cv=False, n_envs=8):
     start_time = time.time()
 
     alg = 'PPO'
@@ -22,22 +24,43 @@ def learn(obs_type, cv=False):
     sumo_cmd = set_sumo()
     gamma = 0.65
     lr = get_linear_fn(0.001, 0.0001, 0.5)
-    n_envs = 8
     train_freq = 400
+    compile_policy = True  # torch.compile the features and mlp extractors of the policy
+
+    # Only one SUMO simulation can run per process (libsumo, or traci's default connection), so several envs need
+    # subprocesses. A single env runs in-process and skips the pipe and pickling on every step.
+    vec_env_cls = SubprocVecEnv if n_envs > 1 else DummyVecEnv
+    vec_env_kwargs = None
+    if vec_env_cls is SubprocVecEnv and sys.platform.startswith('linux') and not th.cuda.is_initialized():
+        # Forked workers share the already imported libraries instead of re-importing them. Only on Linux: Windows has
+        # no fork, and forking after torch is imported is unsafe on macOS, which defaults to spawn. A CUDA context
+        # cannot be used in a forked child either, so SB3's default start method is kept once CUDA is initialized.
+        vec_env_kwargs = dict(start_method='fork')
 
     env = make_vec_env(
         SumoEnv,
         n_envs=n_envs,
-        vec_env_cls=SubprocVecEnv,
+        vec_env_cls=vec_env_cls,
+        vec_env_kwargs=vec_env_kwargs,
         env_kwargs=dict(
             sumo_cmd=sumo_cmd,
             obs_type=obs_type,
             cv_only=cv,
         ),
     )
-    env = VecNormalize(env, gamma=gamma)
+    # The image planes are left unnormalized and divided by their physical maxima inside the features extractor
+    if obs_type == 'img':
+        env = VecNormalize(env, norm_obs=False, gamma=gamma)
+    elif obs_type == 'comb':
+        env = VecNormalize(env, norm_obs_keys=['vec'], gamma=gamma)
+    else:
+        env = VecNormalize(env, gamma=gamma)
     env = VecMonitor(env, log_dir)
 
+    # bfloat16 autocast and channels-last for the CNN features extractor, only where bfloat16 is not emulated.
+    # Probed after the subprocesses are started, as it initializes CUDA.
+    mixed_precision = bf16_supported()
+
     if alg == 'PPO':
         hyperparams = {
             "learning_rate": lr,
@@ -86,7 +109,12 @@ def learn(obs_type, cv=False):
 
         policy_kwargs = dict(
             features_extractor_class=features_extractor,
-            features_extractor_kwargs=dict(features_dim=128),
+            features_extractor_kwargs=dict(
+                features_dim=128,
+                mixed_precision=mixed_precision,
+                # Occupancy and speed planes of the image
+                channel_scale=(max(car_occupancy, bus_occupancy), speed_limit),
+            ),
             # share_features_extractor=False,
             # net_arch=dict(pi=[32, 32], vf=[64, 64]),
             # activation_fn=th.nn.ReLU,
@@ -102,6 +130,23 @@ def learn(obs_type, cv=False):
             tensorboard_log=log_dir,
         )
 
+        if mixed_precision:
+            model.policy.to(memory_format=th.channels_last)
+
+    # 'medium' would be process-wide and let the float32 policy and value heads use bfloat16 matmuls as well
+    th.set_float32_matmul_precision('high')
+    # The input shape is fixed, so cuDNN can pick the fastest convolution algorithm once
+    th.backends.cudnn.benchmark = True
+    if compile_policy:
+        # Compile the submodules in place so the saved state_dict keys stay the same, both forward() and
+        # evaluate_actions() go through them. Fall back to eager mode if compiling is not supported.
+        try:
+            th._dynamo.config.suppress_errors = True
+            for module in (model.policy.features_extractor, model.policy.mlp_extractor):
+                module.compile(mode='reduce-overhead' if th.cuda.is_available() else 'default')
+        except AttributeError:  # torch < 2.2
+            pass
+
     # print(model.policy)
 
     # check_freq = 1000
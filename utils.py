@@ -70,7 +70,8 @@ def save_data(file_tosave, model_path):
     copyfile(file_tosave, os.path.join(model_path, file_tosave))
 
 
-def set_sumo(gui=False, sumocfg_path='data/Eastway-Central.sumocfg', random=True, log_path=None, seed=-1):
+def set_sumo(gui=False, sumocfg_path='data/Eastway-Central.sumocfg', random=True, log_path=None, seed=-1,
+             threads=0, ballistic=False):
     # we need to import python modules from the $SUMO_HOME/tools directory
     if 'SUMO_HOME' in os.environ:
         tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
@@ -103,6 +104,14 @@ def set_sumo(gui=False, sumocfg_path='data/Eastway-Central.sumocfg', random=True
     else:
         sumo_cmd = [sumoBinary, '-c', sumocfg_path, '--no-warnings', '--no-step-log']
 
+    # Parallel vehicle updates for large scenarios, '--threads' is still experimental in SUMO, so compare the results
+    # against a run without it first
+    if threads > 0:
+        sumo_cmd += ['--threads', str(threads), '--device.rerouting.threads', str(threads)]
+    # Ballistic integration changes the vehicle trajectories, i.e. the dynamics model of the simulation
+    if ballistic:
+        sumo_cmd += ['--step-method.ballistic', 'true']
+
     return sumo_cmd
 
 